@@ -1,9 +1,11 @@
-import os, re, json, feedparser, requests
+import os, json, time, calendar, queue, threading, asyncio, aiohttp, feedparser, orjson, smtplib, sqlite3
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse, quote_plus
 from email.mime.text import MIMEText
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 
 load_dotenv()
 
@@ -17,30 +19,86 @@ EMAIL_TO   = os.getenv("EMAIL_TO", "")
 NEWS_LOOKBACK_DAYS = int(os.getenv("NEWS_LOOKBACK_DAYS", "14"))
 KEY_TERMS = [t.strip().lower() for t in os.getenv("NEWS_KEY_TERMS","").split(",") if t.strip()]
 
-HEADERS = {"User-Agent":"Mozilla/5.0 (Aviron-News-Monitor)"}
-HISTORY_FILE = "news_history.json"
+# Ask for compressed feeds; aiohttp only decodes brotli when the brotli package is installed
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
 
-def send_email(subject, body):
-    import smtplib
-    if not (EMAIL_HOST and EMAIL_USER and EMAIL_PASS and EMAIL_TO):
+HEADERS = {"User-Agent":"Mozilla/5.0 (Aviron-News-Monitor)", "Accept-Encoding": ACCEPT_ENCODING}
+SEEN_DB = "news_history.db"          # seen links, one row each
+HISTORY_FILE = "news_history.json"   # legacy seen-links list, imported into SEEN_DB once
+FEED_META_FILE = "feed_meta.json"  # feed url -> {"etag", "last_modified"} for conditional GETs
+FEED_FAILURES_FILE = "feed_failures.json"  # feed url -> {"fails", "retry_at"} for dead endpoints
+FEED_FAIL_TTL_HOURS = float(os.getenv("FEED_FAIL_TTL_HOURS", "6"))  # first back-off after a failed fetch
+FEED_FAIL_MAX_DAYS = float(os.getenv("FEED_FAIL_MAX_DAYS", "7"))    # back-off cap (doubles per failure)
+FEED_CONCURRENCY = int(os.getenv("FEED_CONCURRENCY", "10"))  # max feeds in flight at once
+# Content types that are definitely not a feed; anything else (xml, rss, missing...) is downloaded
+NON_FEED_TYPES = {"text/html", "application/xhtml+xml"}
+
+def email_enabled():
+    return bool(EMAIL_HOST and EMAIL_USER and EMAIL_PASS and EMAIL_TO)
+
+@contextmanager
+def open_smtp():
+    """Yield one logged-in SMTP connection (None when email isn't configured)."""
+    if not email_enabled():
+        yield None
+        return
+    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=30) as s:
+        s.starttls()
+        s.login(EMAIL_USER, EMAIL_PASS)
+        yield s
+
+def send_email(subject, body, smtp=None):
+    if not email_enabled():
         print("[email disabled] " + subject)
         return
+    if smtp is None:
+        with open_smtp() as s:
+            return send_email(subject, body, smtp=s)
     msg = MIMEText(body, "plain", "utf-8")
     msg["Subject"] = subject
     msg["From"] = EMAIL_FROM
     msg["To"] = EMAIL_TO
-    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=30) as s:
-        s.starttls()
-        s.login(EMAIL_USER, EMAIL_PASS)
-        s.sendmail(EMAIL_FROM, [EMAIL_TO], msg.as_string())
+    smtp.sendmail(EMAIL_FROM, [EMAIL_TO], msg.as_string())
+
+def start_mailer():
+    """
+    Log in to SMTP on a background thread so the handshake overlaps feed fetching.
+    Put (subject, body) per digest on the returned queue, then None, then join() it;
+    any send/connection error is left in the returned list for the caller to raise.
+    """
+    q = queue.Queue()
+    errors = []
+
+    def run():
+        finished = False
+        try:
+            with open_smtp() as s:
+                while not finished:
+                    item = q.get()
+                    try:
+                        if item is None:
+                            finished = True
+                        else:
+                            send_email(*item, smtp=s)
+                    finally:
+                        q.task_done()
+        except Exception as e:
+            errors.append(e)
+            while not finished:  # drop the rest so join() still returns
+                finished = q.get() is None
+                q.task_done()
+
+    threading.Thread(target=run, daemon=True).start()
+    return q, errors
 
 def now_utc():
     return datetime.now(timezone.utc)
 
-def in_window(dt):
-    return dt >= now_utc() - timedelta(days=NEWS_LOOKBACK_DAYS)
-
-def load_seen():
+def load_legacy_seen():
     if not os.path.exists(HISTORY_FILE): return set()
     try:
         with open(HISTORY_FILE, "r", encoding="utf-8") as f:
@@ -48,9 +106,53 @@ def load_seen():
     except Exception:
         return set()
 
-def save_seen(seen):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(sorted(seen), f, indent=2)
+def open_seen():
+    """Open the seen-links table, seeding it from news_history.json the first time."""
+    conn = sqlite3.connect(SEEN_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS seen(link TEXT PRIMARY KEY)")
+    if conn.execute("SELECT 1 FROM seen LIMIT 1").fetchone() is None:
+        legacy = load_legacy_seen()
+        if legacy:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO seen(link) VALUES (?)", ((l,) for l in sorted(legacy)))
+    return conn
+
+def is_seen(conn, link):
+    return conn.execute("SELECT 1 FROM seen WHERE link=? LIMIT 1", (link,)).fetchone() is not None
+
+def write_json_atomic(path, data, option=0):
+    # temp file + rename so a crash mid-write never leaves a truncated file behind
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | option))
+    os.replace(tmp, path)
+
+def save_seen(conn, links):
+    """Add this run's new links in one transaction and close the store."""
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO seen(link) VALUES (?)", ((l,) for l in links))
+    conn.close()
+
+def load_state(path):
+    if not os.path.exists(path): return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_state(path, data):
+    write_json_atomic(path, data, orjson.OPT_SORT_KEYS)
+
+def record_feed_result(failures, url, ok):
+    """Forget a feed that worked; push a failing one's next retry out exponentially."""
+    if ok:
+        failures.pop(url, None)
+        return
+    fails = failures.get(url, {}).get("fails", 0) + 1
+    ttl = min(FEED_FAIL_TTL_HOURS * 3600 * 2 ** (fails - 1), FEED_FAIL_MAX_DAYS * 86400)
+    failures[url] = {"fails": fails, "retry_at": int(time.time() + ttl)}
 
 def try_common_feeds(homepage):
     suffixes = ["feed", "feed.xml", "rss", "rss.xml", "atom.xml", "blog/feed", "news/feed"]
@@ -64,9 +166,53 @@ def google_news_rss_for_keyword(keyword):
     q = quote_plus(keyword)
     return f"https://news.google.com/rss/search?q={q}&hl=en-US&gl=US&ceid=US:en"
 
-def fetch_entries(feed_url):
+async def fetch_bytes(session, sem, url, meta, probe=False):
+    """
+    GET a feed, sending last run's ETag/Last-Modified. Returns None on 304 Not Modified.
+    probe=True (guessed URLs) sends a HEAD first and skips the download if it's an HTML page.
+    """
+    cached = meta.get(url) or {}
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    async with sem:
+        if probe and not cached:
+            async with session.head(url, allow_redirects=True) as head:
+                if head.status not in (405, 501):  # HEAD not supported -> just GET
+                    head.raise_for_status()
+                    ctype = head.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                    if ctype in NON_FEED_TYPES:
+                        return b""  # homepage / soft-404, not a feed
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return None  # unchanged: every entry was handled on a previous run
+            resp.raise_for_status()
+            data = await resp.read()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+
+    if etag or last_modified:
+        meta[url] = {"etag": etag, "last_modified": last_modified}
+    else:
+        meta.pop(url, None)
+    return data
+
+async def fetch_all(urls, meta, probe_urls=()):
+    """Download every feed concurrently; failures come back as exceptions, in order."""
+    sem = asyncio.Semaphore(FEED_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout) as session:
+        return await asyncio.gather(*[fetch_bytes(session, sem, u, meta, u in probe_urls) for u in urls], return_exceptions=True)
+
+def parse_entries(data):
+    # feedparser only does CPU work here: the bytes were already fetched (None == 304, nothing new)
+    if not data or isinstance(data, BaseException):
+        return []
     try:
-        parsed = feedparser.parse(feed_url)
+        parsed = feedparser.parse(data)
         return parsed.entries or []
     except Exception:
         return []
@@ -88,10 +234,19 @@ def main():
     with open("competitors_news.csv", newline="", encoding="utf-8") as f:
         rows = list(csv.DictReader(f))
 
-    seen = load_seen()
+    now = now_utc()  # one clock reading for the whole run
+    cutoff = now - timedelta(days=NEWS_LOOKBACK_DAYS)
+    mailer, mail_errors = start_mailer()  # SMTP login runs while feeds download
+    seen_db = open_seen()
+    seen_now = set()  # links added during this run, not yet written to seen_db
+    feed_meta = load_state(FEED_META_FILE)
+    feed_failures = load_state(FEED_FAILURES_FILE)
     new_links_global = []
     items_by_comp = {}  # comp -> list of dicts
 
+    # Build every (competitor, feed) pair up front so all feeds download in one concurrent batch
+    jobs = []
+    probe_urls = set()  # guessed endpoints, HEAD-checked before downloading
     for r in rows:
         comp = (r.get("competitor") or "").strip()
         homepage = (r.get("homepage_url") or "").strip().rstrip("/")
@@ -104,6 +259,7 @@ def main():
         else:
             # Try common feed endpoints first
             feeds = try_common_feeds(homepage)
+            probe_urls.update(feeds)
             # Fallbacks: domain-scoped and keyword Google News RSS
             try:
                 domain = urlparse(homepage).netloc
@@ -114,61 +270,88 @@ def main():
             if keyword:
                 feeds.append(google_news_rss_for_keyword(keyword))
 
-        for f in feeds:
-            entries = fetch_entries(f)
-            for e in entries:
-                title = getattr(e, "title", "").strip()
-                link = normalize_link(getattr(e, "link", "") or getattr(e, "id", ""))
-                if not link or link in seen:
-                    continue
-
-                # Date: prefer structured times; if missing, treat as "now" (so it's included)
-                dt = None
-                st = getattr(e, "published_parsed", None) or getattr(e, "updated_parsed", None)
-                if st:
+        jobs.extend((comp, f) for f in feeds)
+
+    urls = list(dict.fromkeys(f for _, f in jobs))  # same feed listed twice is fetched once
+    now_ts = time.time()
+    urls = [u for u in urls if feed_failures.get(u, {}).get("retry_at", 0) <= now_ts]  # skip known-dead feeds
+    payloads = dict(zip(urls, asyncio.run(fetch_all(urls, feed_meta, probe_urls))))
+
+    entries_by_feed = {}
+    for u, data in payloads.items():
+        entries_by_feed[u] = parse_entries(data)
+        # 304 (None) is healthy; an error or a body with no entries counts as a failure
+        ok = data is None or bool(entries_by_feed[u])
+        if not ok:
+            feed_meta.pop(u, None)  # don't let a 304 on an empty page clear the failure later
+        record_feed_result(feed_failures, u, ok)
+
+    for comp, f in jobs:
+        entries = entries_by_feed.get(f, [])
+        for e in entries:
+            # Most entries were seen on an earlier run: test the raw link before normalizing it
+            raw_link = getattr(e, "link", "") or getattr(e, "id", "")
+            if not raw_link or raw_link in seen_now or is_seen(seen_db, raw_link):
+                continue
+            link = normalize_link(raw_link)
+            if not link or (link != raw_link and (link in seen_now or is_seen(seen_db, link))):
+                continue
+
+            title = getattr(e, "title", "").strip()
+
+            # Date: prefer structured times; if missing, treat as "now" (so it's included)
+            dt = None
+            st = getattr(e, "published_parsed", None) or getattr(e, "updated_parsed", None)
+            if st:
+                try:
+                    dt = datetime.fromtimestamp(calendar.timegm(st), timezone.utc)
+                except Exception:
+                    dt = None
+            if dt is None:
+                published_raw = getattr(e, "published", "") or getattr(e, "updated", "")
+                if published_raw:
+                    # feeds use RFC 822 (RSS) or ISO 8601 (Atom) dates
                     try:
-                        dt = datetime(st.tm_year, st.tm_mon, st.tm_mday, st.tm_hour, st.tm_min, st.tm_sec, tzinfo=timezone.utc)
-                    except Exception:
-                        dt = None
-                if dt is None:
-                    published_raw = getattr(e, "published", "") or getattr(e, "updated", "")
-                    if published_raw:
+                        dt = parsedate_to_datetime(published_raw)
+                    except (TypeError, ValueError):
                         try:
-                            import dateutil.parser as dtp
-                            dt = dtp.parse(published_raw)
-                        except Exception:
+                            dt = datetime.fromisoformat(published_raw.strip().replace("Z", "+00:00"))
+                        except ValueError:
                             dt = None
-                if dt is None:
-                    dt = now_utc()  # ← revert behavior: allow undated items
+                    if dt is not None and dt.tzinfo is None:
+                        dt = dt.replace(tzinfo=timezone.utc)
+            if dt is None:
+                dt = now  # ← revert behavior: allow undated items
 
-                if not in_window(dt):
-                    continue
+            if dt < cutoff:
+                continue
 
-                summary = getattr(e, "summary", "")
-                try:
-                    summary_text = BeautifulSoup(summary, "lxml").get_text("\n", strip=True)[:500]
-                except Exception:
-                    summary_text = (summary or "")[:500]
+            summary = getattr(e, "summary", "")
+            try:
+                summary_text = LexborHTMLParser(summary).text(separator="\n", strip=True)[:500]
+            except Exception:
+                summary_text = (summary or "")[:500]
 
-                highlight = any(k in title.lower() for k in KEY_TERMS) if KEY_TERMS else False
+            highlight = any(k in title.lower() for k in KEY_TERMS) if KEY_TERMS else False
 
-                items_by_comp.setdefault(comp, []).append({
-                    "title": title,
-                    "link": link,
-                    "date": dt.isoformat(timespec="seconds"),
-                    "summary": summary_text,
-                    "highlight": highlight,
-                })
-                seen.add(link)
-                new_links_global.append(link)
+            items_by_comp.setdefault(comp, []).append({
+                "title": title,
+                "link": link,
+                "date": dt.isoformat(timespec="seconds"),
+                "summary": summary_text,
+                "highlight": highlight,
+            })
+            seen_now.add(link)
+            new_links_global.append(link)
 
-    # send one email per competitor
+    # send one email per competitor, all over the mailer's single SMTP session
+    queued = 0
     for comp, items in items_by_comp.items():
         if not items:
             continue
         items.sort(key=lambda x: x["date"], reverse=True)
-        start = (now_utc() - timedelta(days=NEWS_LOOKBACK_DAYS)).date()
-        end = now_utc().date()
+        start = cutoff.date()
+        end = now.date()
         lines = [f"[NEWS DIGEST] {comp} — {start} to {end}\n"]
         for it in items:
             star = "🔎 " if it["highlight"] else ""
@@ -177,9 +360,21 @@ def main():
                 lines.append(f"> {it['summary']}\n")
         body = "\n".join(lines)
         subject = f"[NEWS DIGEST] {comp} — {len(items)} item(s)"
-        send_email(subject, body)
+        mailer.put((subject, body))
+        queued += 1
+    mailer.put(None)
+    mailer.join()
+
+    save_state(FEED_FAILURES_FILE, feed_failures)  # back-offs are about fetching, not email
+    if mail_errors:
+        if queued:
+            # keep seen history and ETags as they were so these entries are rebuilt next run
+            # (a saved ETag would turn their feeds into 304s)
+            raise mail_errors[0]
+        print(f"[email error] {mail_errors[0]} (no digests to send)")
 
-    save_seen(seen)
+    save_state(FEED_META_FILE, feed_meta)
+    save_seen(seen_db, new_links_global)
     print(f"Done. Sent {len(items_by_comp)} digest email(s) and {len(new_links_global)} new link(s).")
 
 if __name__ == "__main__":
@@ -1,11 +1,23 @@
-import os, csv, json, re, requests, smtplib, time, random
-from collections import defaultdict
+import os, csv, json, re, orjson, requests, smtplib, time, random, threading, functools
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
 from bs4 import BeautifulSoup
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from cssselect import parse as parse_css
+from cssselect.parser import CombinedSelector, Element as CssElement
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from email.mime.text import MIMEText
 from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote as urlquote
 
+# RE2 (linear-time, no backtracking) for the big-page Peloton scans; stdlib re if not installed
+try:
+    import re2 as _re_fast
+except ImportError:
+    _re_fast = re
+
 # =======================
 # Config / ENV
 # =======================
@@ -32,6 +44,21 @@ EMAIL_TO   = os.getenv("EMAIL_TO", "")  # allow comma-separated list
 DEFAULT_CURRENCY = (os.getenv("DEFAULT_CURRENCY", "USD") or "USD").strip()
 DEFAULT_REGEX = os.getenv("NORMALIZE_REGEX", r"[^0-9\.]")
 
+# Hot-path patterns, compiled once
+_DEFAULT_REGEX_RE = re.compile(DEFAULT_REGEX)
+_DOLLAR_RE = re.compile(r"\$([0-9][\d,\.]+)")
+_WS_RE = re.compile(r"\s+")
+
+# Peloton Affirm footnotes, one per product line. RE2 has no lookahead, so "not followed
+# by +" is spelled (?:[^+]|$).
+_PELOTON_AFFIRM = r"(?i)Get the Peloton {}.*?Based on a price of\s*\$([0-9][\d,\.]+)"
+_PELOTON_RE = {
+    "bike+": _re_fast.compile(_PELOTON_AFFIRM.format(r"Bike\+")),
+    "bike": _re_fast.compile(_PELOTON_AFFIRM.format(r"Bike(?:[^+]|$)")),
+    "tread": _re_fast.compile(_PELOTON_AFFIRM.format(r"Tread(?:[^+]|$)")),
+    "row": _re_fast.compile(_PELOTON_AFFIRM.format(r"Row")),
+}
+
 # Digest behavior
 SEND_EMPTY_DIGEST = os.getenv("SEND_EMPTY_DIGEST", "0") == "1"  # send even if no events
 DIGEST_SUBJECT_PREFIX = os.getenv("DIGEST_SUBJECT_PREFIX", "[PRICE DIGEST]")
@@ -42,16 +69,24 @@ CHANGE_THRESHOLD_PCT = float(os.getenv("CHANGE_THRESHOLD_PCT", "0"))
 # Optional: normalize URLs by removing utm_* so history keys stay stable
 STRIP_UTM = os.getenv("STRIP_UTM", "1") == "1"
 
-# Optional: floor for final fallback (avoid picking monthly fees etc.)
-MIN_PRICE_FLOOR = float(os.getenv("MIN_PRICE_FLOOR", "400"))
-
 # Scraper API (Hydrow only)
 SCRAPERAPI_KEY = os.getenv("SCRAPERAPI_KEY", "").strip()
 
 # Polite crawling / retry
 _LAST_FETCH = {}             # domain -> last fetch time
+_DOMAIN_LOCKS = defaultdict(threading.Lock)  # domain -> lock serializing its fetches
+_DOMAIN_LOCKS_GUARD = threading.Lock()
 MIN_DOMAIN_GAP = float(os.getenv("MIN_DOMAIN_GAP", "3.0"))  # seconds between same-domain requests
 MAX_TRIES = 5                # retries on 429/5xx
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "16"))  # domains scraped in parallel
+STREAM_CHUNK = 64 * 1024     # bytes fed to the HTML pull parser at a time
+DRAIN_LIMIT = 1024 * 1024    # after an early hit, read out at most this much so keep-alive survives
+
+# One shared session so repeat hits on the same host reuse the TCP/TLS connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+for _prefix in ("https://", "http://"):
+    SESSION.mount(_prefix, HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
 
 
 # =======================
@@ -80,16 +115,29 @@ def send_email(subject, body):
 # =======================
 # Utilities
 # =======================
+@functools.lru_cache(maxsize=4096)
+def _cached_split(url: str):
+    """urlsplit, memoized: the same product URL is split several times per row."""
+    return urlsplit(url)
+
+
+def _cached_netloc(url: str) -> str:
+    return _cached_split(url).netloc
+
+
 def _throttle(url: str):
-    """Small per-domain delay + a little jitter to be polite."""
-    dom = urlsplit(url).netloc
-    now = time.time()
-    last = _LAST_FETCH.get(dom, 0)
-    gap = now - last
-    wait = MIN_DOMAIN_GAP - gap + random.uniform(-0.5, 0.8)  # ~±1s jitter
-    if wait > 0:
-        time.sleep(wait)
-    _LAST_FETCH[dom] = time.time()
+    """Small per-domain delay + a little jitter to be polite. Safe to call from worker threads."""
+    dom = _cached_netloc(url)
+    with _DOMAIN_LOCKS_GUARD:
+        lock = _DOMAIN_LOCKS[dom]
+    with lock:
+        now = time.time()
+        last = _LAST_FETCH.get(dom, 0)
+        gap = now - last
+        wait = MIN_DOMAIN_GAP - gap + random.uniform(-0.5, 0.8)  # ~±1s jitter
+        if wait > 0:
+            time.sleep(wait)
+        _LAST_FETCH[dom] = time.time()
 
 
 def maybe_proxy(url: str) -> str:
@@ -97,32 +145,38 @@ def maybe_proxy(url: str) -> str:
     Route Hydrow pages through ScraperAPI when a key is present.
     Everyone else goes direct.
     """
-    if SCRAPERAPI_KEY and "hydrow.com" in url:
+    if SCRAPERAPI_KEY and "hydrow.com" in _cached_netloc(url):
         base = "https://api.scraperapi.com/"
         # you can add &render=true if needed, but try plain first
         return f"{base}?api_key={SCRAPERAPI_KEY}&url={urlquote(url, safe='')}"
     return url
 
 
-def http_get_with_backoff(url: str):
+def http_get_with_backoff(url: str, stream: bool = False):
     delay = 2.0
     for attempt in range(1, MAX_TRIES + 1):
         _throttle(url)
         target = maybe_proxy(url)
-        resp = requests.get(target, headers=HEADERS, timeout=45)
+        resp = SESSION.get(target, timeout=45, stream=stream)
         if resp.status_code == 429:
+            resp.close()  # hand the connection back to the pool before retrying
             wait = delay + random.uniform(0, 1.5)
             print(f"[throttle] 429 from {url} — retry {attempt}/{MAX_TRIES} after {wait:.1f}s")
             time.sleep(wait)
             delay = min(delay * 2, 30)
             continue
         if 500 <= resp.status_code < 600:
+            resp.close()
             wait = delay + random.uniform(0, 1.0)
             print(f"[retry] {resp.status_code} from {url} — retry {attempt}/{MAX_TRIES} after {wait:.1f}s")
             time.sleep(wait)
             delay = min(delay * 2, 30)
             continue
-        resp.raise_for_status()
+        try:
+            resp.raise_for_status()
+        except requests.HTTPError:
+            resp.close()
+            raise
         return resp
     raise ValueError(f"Too Many Requests / server errors after {MAX_TRIES} tries for {url}")
 
@@ -130,7 +184,8 @@ def http_get_with_backoff(url: str):
 def norm_price(text, regex=DEFAULT_REGEX):
     if text is None:
         return None
-    cleaned = re.sub(regex, "", str(text))
+    pattern = _DEFAULT_REGEX_RE if regex == DEFAULT_REGEX else re.compile(regex)
+    cleaned = pattern.sub("", str(text))
     if cleaned.count(".") > 1:
         cleaned = cleaned.replace(".", "", cleaned.count(".") - 1)
     try:
@@ -143,7 +198,7 @@ def normalize_url(u: str) -> str:
     if not u or not STRIP_UTM:
         return u
     try:
-        parts = list(urlsplit(u))
+        parts = list(_cached_split(u))
         qs = [(k, v) for (k, v) in parse_qsl(parts[3]) if not k.lower().startswith("utm_")]
         parts[3] = urlencode(qs)
         return urlunsplit(parts)
@@ -151,50 +206,178 @@ def normalize_url(u: str) -> str:
         return u
 
 
-def extract_price(url, selector, attr="inner_text", regex=DEFAULT_REGEX, product_hint=None):
-    """Extract a price using selector -> JSON-LD -> Peloton-aware fallback -> final largest-$ fallback."""
-    resp = http_get_with_backoff(url)
-    html = resp.text
+def iter_prices(obj):
+    """Yield JSON-LD "price" values depth-first, looking inside "offers" before other keys."""
+    stack = deque([obj])
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("price"):
+                yield node["price"]
+                continue
+            children = [v for k, v in node.items() if k != "offers"]
+            if "offers" in node:
+                children.insert(0, node["offers"])
+            stack.extend(reversed(children))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+
+
+def css_selector(selector):
+    """lxml CSSSelector for `selector`, or None if cssselect can't translate it."""
+    try:
+        return CSSSelector(selector, translator="html")
+    except Exception:
+        return None
+
 
-    # BeautifulSoup with lxml fallback
+def _subject_tags(css):
+    """
+    Tag names the element matched by `css` can have ("div.price, span" -> {"div", "span"}),
+    or None when any tag could match ("*[data-price]", ".price").
+    """
+    tags = set()
     try:
-        soup = BeautifulSoup(html, "lxml")
+        for parsed in parse_css(css):
+            node = parsed.parsed_tree
+            while not isinstance(node, CssElement):
+                node = node.subselector if isinstance(node, CombinedSelector) else node.selector
+            if not node.element or node.element == "*":
+                return None
+            tags.add(node.element.lower())
     except Exception:
-        soup = BeautifulSoup(html, "html.parser")
+        return None
+    return tags
+
 
-    # 1) Primary: user-provided selector
-    node = soup.select_one(selector) if selector else None
-    if node:
-        raw = node.get(attr) if attr and attr != "inner_text" else node.get_text(strip=True)
-        amount = norm_price(raw, regex)
-        if amount is not None:
-            return amount
-        # fall through
+def _node_price(node, attr, regex):
+    if attr and attr != "inner_text":
+        raw = node.get(attr)
+    else:
+        raw = "".join(t.strip() for t in node.itertext())
+    return norm_price(raw, regex)
+
+
+def _element_closed(el):
+    # The parser is past `el` once it, or one of its ancestors, has a following sibling
+    return any(e.getnext() is not None for e in (el, *el.iterancestors()))
+
+
+def _drain(resp, body):
+    """
+    Read out the rest of a bounded body. A response closed half-read makes urllib3
+    drop the socket; one read to the end goes back to SESSION's pool for the next row.
+    Bodies over DRAIN_LIMIT are abandoned instead (a new handshake is cheaper).
+    """
+    length = resp.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > DRAIN_LIMIT:
+        return
+    read = 0
+    for chunk in body:
+        read += len(chunk)
+        if read > DRAIN_LIMIT:
+            return
+
+
+def stream_page(resp, sel, attr, regex):
+    """
+    Feed the body to lxml's pull parser as it downloads, collecting JSON-LD scripts and
+    checking the selector as elements arrive. Returns (amount, ld_json_texts, html, sel_failed).
+    When the selector yields a price we stop reading early and html is None. sel_failed is
+    True when the compiled XPath can't run on lxml's tree (e.g. soupsieve's :contains),
+    so the caller can retry the selector with BeautifulSoup on the full html.
+
+    sel() scans the whole tree parsed so far, so it only re-runs once an element with
+    the selector's tag has closed, and at most each time the fed size doubles; that
+    keeps a miss linear in page size instead of quadratic.
+    """
+    parser = etree.HTMLPullParser(events=("end",))
+    chunks, ld_json = [], []
+    root = None
+    pending = sel is not None
+    inner_text = not attr or attr == "inner_text"
+    tags = _subject_tags(sel.css) if pending else None
+    candidate = False   # an element that could match has closed since the last sel() run
+    fed = next_check = 0
+    sel_failed = False
+
+    def run_sel():
+        nonlocal pending, sel_failed
+        try:
+            return sel(root)
+        except etree.XPathError:
+            pending = False
+            sel_failed = True
+            return []
+
+    def drain():
+        nonlocal root, candidate
+        for _, el in parser.read_events():
+            if root is None:
+                root = el.getroottree().getroot()
+            if tags is None or el.tag in tags:
+                candidate = True
+            if el.tag == "script" and (el.get("type") or "").strip().lower() == "application/ld+json":
+                ld_json.append((el.text or "").strip())
+
+    body = resp.iter_content(STREAM_CHUNK)
+    for chunk in body:
+        chunks.append(chunk)
+        parser.feed(chunk)
+        fed += len(chunk)
+        drain()
+        if pending and candidate and root is not None and fed >= next_check:
+            candidate = False
+            next_check = fed * 2
+            hits = run_sel()
+            if hits and (not inner_text or _element_closed(hits[0])):
+                pending = False  # only the first match counts, like select_one
+                amount = _node_price(hits[0], attr, regex)
+                if amount is not None:
+                    _drain(resp, body)
+                    return amount, ld_json, None, False
+
+    try:
+        root = parser.close()
+    except etree.LxmlError:
+        pass  # empty / unparsable body: the regex fallbacks still get a look
+    drain()
+    if pending and root is not None:
+        hits = run_sel()
+        if hits:
+            amount = _node_price(hits[0], attr, regex)
+            if amount is not None:
+                return amount, ld_json, None, False
+
+    html = b"".join(chunks).decode(resp.encoding or "utf-8", errors="replace")
+    return None, ld_json, html, sel_failed
+
+
+def extract_price(url, selector, attr="inner_text", regex=DEFAULT_REGEX, product_hint=None):
+    """Extract a price using selector -> JSON-LD -> Peloton-aware fallback -> final largest-$ fallback."""
+    sel = css_selector(selector) if selector else None
+
+    # 1) Primary: user-provided selector, matched while the page streams in
+    with http_get_with_backoff(url, stream=True) as resp:
+        amount, ld_json, html, sel_failed = stream_page(resp, sel, attr, regex)
+    if amount is not None:
+        return amount
+
+    # Selectors cssselect can't translate or lxml can't evaluate (soupsieve extensions
+    # like :contains) get a full BeautifulSoup pass
+    if selector and (sel is None or sel_failed):
+        node = BeautifulSoup(html, "lxml").select_one(selector)
+        if node:
+            raw = node.get(attr) if attr and attr != "inner_text" else node.get_text(strip=True)
+            amount = norm_price(raw, regex)
+            if amount is not None:
+                return amount
 
     # 2) Fallback: JSON-LD price fields
-    import json as _json
-    for s in soup.select('script[type="application/ld+json"]'):
+    for text in ld_json:
         try:
-            data = _json.loads(s.get_text(strip=True))
-            def find_price(obj):
-                if isinstance(obj, dict):
-                    if "price" in obj and obj["price"]:
-                        return obj["price"]
-                    if "offers" in obj:
-                        p = find_price(obj["offers"])
-                        if p is not None:
-                            return p
-                    for v in obj.values():
-                        p = find_price(v)
-                        if p is not None:
-                            return p
-                elif isinstance(obj, list):
-                    for it in obj:
-                        p = find_price(it)
-                        if p is not None:
-                            return p
-                return None
-            p = find_price(data)
+            data = json.loads(text)
+            p = next(iter_prices(data), None)
             if p is not None:
                 amount = norm_price(str(p), regex)
                 if amount is not None:
@@ -204,31 +387,32 @@ def extract_price(url, selector, attr="inner_text", regex=DEFAULT_REGEX, product
 
     # 3) Fallback (Peloton): Affirm footnote "Based on a price of $X" matched to the product
     if "onepeloton.com" in url and product_hint:
-        text = re.sub(r"\s+", " ", html)
+        text = _WS_RE.sub(" ", html)
         ph = product_hint.lower()
         if "bike+" in ph or "bike plus" in ph:
-            pat = r"Get the Peloton Bike\+.*?Based on a price of\s*\$([0-9][\d,\.]+)"
+            pat = _PELOTON_RE["bike+"]
         elif "bike" in ph:
-            pat = r"Get the Peloton Bike(?!\+).*?Based on a price of\s*\$([0-9][\d,\.]+)"
+            pat = _PELOTON_RE["bike"]
         elif "tread" in ph or "treadmill" in ph:
-            pat = r"Get the Peloton Tread(?!\+).*?Based on a price of\s*\$([0-9][\d,\.]+)"
+            pat = _PELOTON_RE["tread"]
         elif "row" in ph:
-            pat = r"Get the Peloton Row.*?Based on a price of\s*\$([0-9][\d,\.]+)"
+            pat = _PELOTON_RE["row"]
         else:
             pat = None
         if pat:
-            m = re.search(pat, text, flags=re.I)
+            m = pat.search(text)
             if m:
                 amt = norm_price(m.group(1), regex)
                 if amt is not None:
                     return amt
 
-    # 4) FINAL fallback: pick the largest dollar amount on page (above a floor)
-    amounts = [norm_price(n, regex) for n in re.findall(r"\$([0-9][\d,\.]+)", html)]
-    amounts = [a for a in amounts if a is not None]
-    if amounts:
-        candidates = [a for a in amounts if a >= MIN_PRICE_FLOOR] or amounts
-        return max(candidates)
+    # 4) FINAL fallback: pick the largest dollar amount on page (skips monthly fees etc.)
+    # Same capture as always ("$" + at least two chars, row regex + multi-dot cleanup via
+    # norm_price), streamed through one generator instead of intermediate lists
+    amounts = (norm_price(m.group(1), regex) for m in _DOLLAR_RE.finditer(html))
+    amount = max((a for a in amounts if a is not None), default=None)
+    if amount is not None:
+        return amount
 
     raise ValueError("Selector not found and no fallback price detected")
 
@@ -242,14 +426,46 @@ def load_history():
 
 
 def save_history(data):
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
     tmp = HISTORY_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    with open(tmp, "wb") as f:
+        f.write(payload)
     try:
         os.replace(tmp, HISTORY_FILE)  # atomic replace (good for OneDrive/Dropbox)
     except Exception:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        with open(HISTORY_FILE, "wb") as f:
+            f.write(payload)
+
+
+def scrape_domain(jobs):
+    """Scrape one domain's rows in order; returns [(idx, amount_or_exception)]."""
+    results = []
+    for idx, job in jobs:
+        try:
+            amount = extract_price(job["url"], job["selector"], job["attr"], job["regex"], product_hint=job["name"])
+        except Exception as e:
+            amount = e
+        results.append((idx, amount))
+    return results
+
+
+def scrape_all(jobs):
+    """
+    Run extract_price for every job, one worker per domain so each host
+    still sees serialized, throttled requests. Returns {idx: amount_or_exception}.
+    """
+    by_domain = defaultdict(list)
+    for idx, job in enumerate(jobs):
+        by_domain[_cached_netloc(job["url"])].append((idx, job))
+    if not by_domain:
+        return {}
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(by_domain))) as pool:
+        futures = [pool.submit(scrape_domain, dom_jobs) for dom_jobs in by_domain.values()]
+        for fut in as_completed(futures):
+            results.update(fut.result())
+    return results
 
 
 # =======================
@@ -268,6 +484,7 @@ def main():
     change_count = 0
     error_count = 0
 
+    jobs = []
     for r in rows:
         comp = (r.get("competitor") or "").strip()
         name = (r.get("product_name") or "").strip() or "Product"
@@ -281,10 +498,19 @@ def main():
             print(f"[skip] {comp} — {name}: missing url or selector")
             continue
 
-        try:
-            amount = extract_price(url, selector, attr, regex, product_hint=name)
-        except Exception as e:
-            line = f"ERROR • {comp} — {name}: {e}\n{url}"
+        jobs.append({
+            "comp": comp, "name": name, "url": url, "selector": selector,
+            "attr": attr, "currency": currency, "regex": regex,
+        })
+
+    # Fetch in parallel across domains, then diff against history in watchlist order
+    amounts = scrape_all(jobs)
+
+    for idx, job in enumerate(jobs):
+        comp, name, url, currency = job["comp"], job["name"], job["url"], job["currency"]
+        amount = amounts[idx]
+        if isinstance(amount, Exception):
+            line = f"ERROR • {comp} — {name}: {amount}\n{url}"
             print(line)
             events_by_comp[comp].append(line)
             error_count += 1